@@ -0,0 +1,362 @@
+import json
+import os
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from haystack import Document, component
+from haystack.components.embedders import SentenceTransformersDocumentEmbedder
+from haystack.utils import ComponentDevice
+
+# The Sentence Transformers model used for both indexing and querying.
+# Documents and queries must always be embedded with the same model.
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+
+# --- Preprocessors ---
+
+@lru_cache(maxsize=None)
+def get_tokenizer(name_or_path: str):
+    """Returns the (fast) tokenizer for a model, loaded once per process."""
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(name_or_path)
+
+@component
+class TokenSplitter:
+    """
+    Splits Documents into overlapping windows of a fixed number of tokens of the
+    embedding model, so that chunks line up with the model's context window
+    (256 word pieces for all-MiniLM-L6-v2) instead of varying with sentence length.
+    """
+
+    def __init__(self, tokenizer: str = f"sentence-transformers/{EMBEDDING_MODEL}", split_length: int = 200, split_overlap: int = 40):
+        self.tokenizer = tokenizer
+        self.split_length = split_length
+        self.split_overlap = split_overlap
+
+    @component.output_types(documents=List[Document])
+    def run(self, documents: List[Document]):
+        tokenizer = get_tokenizer(self.tokenizer)
+        step = self.split_length - self.split_overlap
+        splits = []
+        for doc in documents:
+            if not doc.content:
+                continue
+            # Each document is tokenized once. Chunks are cut from the original
+            # text through the character offsets of their tokens rather than by
+            # decoding them, which would lowercase and re-space the text.
+            offsets = tokenizer(doc.content, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]
+            if not offsets:
+                continue
+            for split_id, start in enumerate(range(0, max(len(offsets) - self.split_overlap, 1), step)):
+                window = offsets[start:start + self.split_length]
+                splits.append(Document(
+                    content=doc.content[window[0][0]:window[-1][1]],
+                    meta={**doc.meta, "source_id": doc.id, "split_id": split_id},
+                ))
+        return {"documents": splits}
+
+# --- Document Writers ---
+
+@component
+class BulkChromaWriter:
+    """
+    Writes Documents to a ChromaDocumentStore in large batches through the
+    underlying Chroma collection, instead of one `collection.add` call per
+    Document as `ChromaDocumentStore.write_documents` does.
+    """
+
+    def __init__(self, document_store, batch_size: int = 5000):
+        # Chroma caps the number of records per call (~5400 with the SQLite backend).
+        self.document_store = document_store
+        self.batch_size = batch_size
+
+    @staticmethod
+    def _chroma_metadata(meta: Dict[str, Any]):
+        # Chroma only accepts scalar metadata values and rejects empty dicts.
+        metadata = {key: value for key, value in meta.items() if isinstance(value, (str, int, float, bool))}
+        return metadata or None
+
+    @component.output_types(documents_written=int)
+    def run(self, documents: List[Document]):
+        collection = self.document_store._collection
+        for start in range(0, len(documents), self.batch_size):
+            batch = documents[start:start + self.batch_size]
+            # Upsert so that re-indexing unchanged content (same IDs) is idempotent.
+            collection.upsert(
+                ids=[doc.id for doc in batch],
+                embeddings=np.stack([doc.embedding for doc in batch]).astype(np.float32).tolist(),
+                documents=[doc.content for doc in batch],
+                metadatas=[self._chroma_metadata(doc.meta) for doc in batch],
+            )
+        return {"documents_written": len(documents)}
+
+# --- INT8 Vector Index ---
+
+def quantize_int8(embeddings: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Quantizes a (n, dim) float matrix to INT8 with one symmetric scale per vector,
+    and returns the INT8 matrix together with the (n,) scales.
+    """
+    scales = 127.0 / np.clip(np.abs(embeddings).max(axis=1), 1e-12, None)
+    return np.rint(embeddings * scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+class Int8EmbeddingStore:
+    """
+    Wraps a ChromaDocumentStore and answers `search_embeddings` by an exhaustive
+    scan over an INT8 copy of the collection's embeddings, instead of Chroma's
+    FP32 HNSW index. Chroma only stores FP32 vectors, so the INT8 copy is kept
+    next to the database (see `export`). The copy takes a quarter of the disk and
+    memory of FP32 vectors; recall loss on MiniLM embeddings is typically below 1%.
+
+    Every other attribute is delegated to the wrapped store, so this can be passed
+    to ChromaEmbeddingRetriever in place of the ChromaDocumentStore.
+    """
+
+    def __init__(self, document_store, path: Path, block_size: int = 4096):
+        self.document_store = document_store
+        self.block_size = block_size
+        # Memory-mapped, so worker processes share the matrix through the page cache.
+        self.embeddings = np.load(path / "embeddings.npy", mmap_mode="r")
+        self.scales = np.load(path / "scales.npy")
+        self.ids = json.loads((path / "ids.json").read_text())
+
+    def __getattr__(self, name):
+        return getattr(self.document_store, name)
+
+    @staticmethod
+    def export(document_store, path: Path, page_size: int = 5000):
+        """Writes an INT8 copy of all embeddings in the store's collection to `path`."""
+        collection = document_store._collection
+        ids, pages = [], []
+        for offset in range(0, collection.count(), page_size):
+            page = collection.get(include=["embeddings"], limit=page_size, offset=offset)
+            ids.extend(page["ids"])
+            # Quantized page by page, so only one page is held in FP32 at a time.
+            pages.append(quantize_int8(np.asarray(page["embeddings"], dtype=np.float32)))
+        if pages:
+            embeddings, scales = np.concatenate([page[0] for page in pages]), np.concatenate([page[1] for page in pages])
+        else:
+            embeddings, scales = np.empty((0, 0), np.int8), np.empty(0, np.float32)
+
+        path.mkdir(parents=True, exist_ok=True)
+        np.save(path / "embeddings.npy", embeddings)
+        np.save(path / "scales.npy", scales)
+        (path / "ids.json").write_text(json.dumps(ids))
+
+    def search_embeddings(self, query_embeddings: List[List[float]], top_k: int, filters: Optional[Dict[str, Any]] = None) -> List[List[Document]]:
+        # Same signature as ChromaDocumentStore.search_embeddings, which
+        # ChromaEmbeddingRetriever calls with the filters as a positional argument.
+        candidates = len(self.ids)
+        excluded = None
+        if filters:
+            # The filters are resolved to the matching IDs by the wrapped store,
+            # which translates them to Chroma's `where` clauses.
+            matching_ids = {doc.id for doc in self.document_store.filter_documents(filters)}
+            excluded = np.fromiter((doc_id not in matching_ids for doc_id in self.ids), dtype=bool, count=len(self.ids))
+            candidates -= int(excluded.sum())
+        if not candidates:
+            return [[] for _ in query_embeddings]
+
+        # numpy has no BLAS kernel for INT8 products, so the INT8 rows are converted
+        # to FP32 one block at a time and multiplied with the (unquantized) queries
+        # by BLAS, then rescaled to cosine similarities.
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        similarities = np.empty((len(queries), len(self.ids)), dtype=np.float32)
+        for start in range(0, len(self.ids), self.block_size):
+            block = self.embeddings[start:start + self.block_size].astype(np.float32)
+            np.matmul(queries, block.T, out=similarities[:, start:start + self.block_size])
+        similarities /= self.scales
+        if excluded is not None:
+            similarities[:, excluded] = -np.inf
+
+        k = min(top_k, candidates)
+        top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        rows = np.arange(len(top))[:, None]
+        top = top[rows, np.argsort(-similarities[rows, top], axis=1)]
+
+        # Fetch the content of all hits of the batch in one call.
+        hit_ids = list({self.ids[i] for i in top.ravel()})
+        result = self.document_store._collection.get(ids=hit_ids, include=["documents", "metadatas", "embeddings"])
+        records = {
+            doc_id: (content, meta, embedding)
+            for doc_id, content, meta, embedding in zip(result["ids"], result["documents"], result["metadatas"], result["embeddings"])
+        }
+
+        documents_per_query = []
+        for query_top, query_similarities in zip(top, similarities):
+            documents = []
+            for i in query_top:
+                content, meta, embedding = records[self.ids[i]]
+                # Reported as cosine distance, like Chroma's own cosine index.
+                documents.append(Document(
+                    id=self.ids[i], content=content, meta=dict(meta or {}),
+                    embedding=list(embedding), score=float(1 - query_similarities[i]),
+                ))
+            documents_per_query.append(documents)
+        return documents_per_query
+
+# --- Rankers ---
+
+@component
+class MMRReranker:
+    """
+    Re-ranks retrieved Documents with Maximal Marginal Relevance, trading off
+    similarity to the query against similarity to the Documents already picked,
+    so that near-duplicate chunks don't crowd out the rest of the context.
+    """
+
+    def __init__(self, top_k: int = 5, lambda_mult: float = 0.5):
+        # lambda_mult = 1 ranks by query similarity only, 0 by diversity only.
+        self.top_k = top_k
+        self.lambda_mult = lambda_mult
+
+    @component.output_types(documents=List[Document])
+    def run(self, query_embedding: List[float], documents: List[Document]):
+        if len(documents) <= self.top_k or any(doc.embedding is None for doc in documents):
+            return {"documents": documents[:self.top_k]}
+
+        embeddings = np.asarray([doc.embedding for doc in documents], dtype=np.float32)
+        embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query /= max(float(np.linalg.norm(query)), 1e-12)
+
+        # All cosine similarities are computed up front as two matrix products.
+        query_sims = embeddings @ query
+        doc_sims = embeddings @ embeddings.T
+
+        selected = [int(np.argmax(query_sims))]
+        # Highest similarity of each candidate to any selected Document so far.
+        max_doc_sims = doc_sims[selected[0]].copy()
+        while len(selected) < self.top_k:
+            scores = self.lambda_mult * query_sims - (1 - self.lambda_mult) * max_doc_sims
+            scores[selected] = -np.inf
+            best = int(np.argmax(scores))
+            selected.append(best)
+            np.maximum(max_doc_sims, doc_sims[best], out=max_doc_sims)
+
+        return {"documents": [documents[i] for i in selected]}
+
+# --- ONNX Runtime Embedders ---
+
+# Number of intra-op threads of the ONNX Runtime sessions created in this
+# process, or None for ONNX Runtime's default of one per physical core.
+_ORT_NUM_THREADS = None
+
+def set_embedding_threads(num_threads: int):
+    """
+    Limits the CPU threads used by the embedding models of this process, e.g. in
+    each worker of a process pool, so that the workers together don't
+    oversubscribe the CPU. Must be called before the models are loaded.
+    """
+    global _ORT_NUM_THREADS
+    import torch
+    torch.set_num_threads(num_threads)
+    _ORT_NUM_THREADS = num_threads
+
+class _ORTEmbeddingBackend:
+    """
+    Runs an ONNX export of the embedding model under ONNX Runtime and applies
+    the same mean pooling and L2 normalization as the Sentence Transformers model.
+    """
+
+    def __init__(self, model_path: str, file_name: str, provider: str):
+        # Imported lazily so that the Sentence Transformers path does not require optimum.
+        import onnxruntime
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+
+        session_options = onnxruntime.SessionOptions()
+        if _ORT_NUM_THREADS:
+            session_options.intra_op_num_threads = _ORT_NUM_THREADS
+        self.tokenizer = get_tokenizer(model_path)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_path, file_name=file_name, provider=provider, session_options=session_options,
+        )
+
+    def embed(self, texts: List[str], batch_size: int, max_length: int) -> np.ndarray:
+        # Tokenize once, then batch the texts by token count so that each batch
+        # is only padded to its own longest text instead of the global maximum.
+        encoded = self.tokenizer(texts, truncation=True, max_length=max_length)
+        order = np.argsort([len(ids) for ids in encoded["input_ids"]], kind="stable")
+
+        embeddings = []
+        for start in range(0, len(texts), batch_size):
+            features = [{key: encoded[key][i] for key in encoded.keys()} for i in order[start:start + batch_size]]
+            inputs = self.tokenizer.pad(features, return_tensors="np")
+            token_embeddings = self.model(**inputs).last_hidden_state
+            mask = inputs["attention_mask"][..., None].astype(np.float32)
+            pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            embeddings.append(pooled / np.linalg.norm(pooled, axis=1, keepdims=True))
+
+        # Scatter the length-sorted embeddings back into the input order.
+        return np.concatenate(embeddings).astype(np.float32)[np.argsort(order)]
+
+@lru_cache(maxsize=None)
+def _load_ort_backend(model_path: str, file_name: str, provider: str, pid: int) -> _ORTEmbeddingBackend:
+    return _ORTEmbeddingBackend(model_path, file_name, provider)
+
+def _get_ort_backend(model_path: str, file_name: str, provider: str) -> _ORTEmbeddingBackend:
+    # Cached so the model is loaded once per process. Keyed by PID because ONNX
+    # Runtime sessions (and their thread pools) are not fork-safe, so a forked
+    # worker must create its own.
+    return _load_ort_backend(model_path, file_name, provider, os.getpid())
+
+@component
+class ORTDocumentEmbedder:
+    """
+    Embeds Documents with an (optionally INT8-quantized) ONNX export of the
+    embedding model. Drop-in replacement for SentenceTransformersDocumentEmbedder.
+    """
+
+    def __init__(self, model_path: str, file_name: str = "model_quantized.onnx", provider: str = "CPUExecutionProvider", batch_size: int = 64, max_seq_length: int = 256):
+        # Sentence Transformers truncates all-MiniLM-L6-v2 inputs at its max_seq_length
+        # of 256 tokens, below the tokenizer's model_max_length of 512.
+        self.model_path = model_path
+        self.file_name = file_name
+        self.provider = provider
+        self.batch_size = batch_size
+        self.max_seq_length = max_seq_length
+        self.backend = None
+
+    def warm_up(self):
+        self.backend = _get_ort_backend(self.model_path, self.file_name, self.provider)
+
+    @component.output_types(documents=List[Document])
+    def run(self, documents: List[Document]):
+        if not documents:
+            return {"documents": []}
+        self.warm_up()
+        embeddings = self.backend.embed([doc.content or "" for doc in documents], self.batch_size, self.max_seq_length)
+        for doc, embedding in zip(documents, embeddings):
+            doc.embedding = embedding.tolist()
+        return {"documents": documents}
+
+def _onnx_model_dir():
+    """
+    Returns the directory of the exported ONNX model (see export_onnx.py) if
+    `ONNX_MODEL_DIR` points to one, otherwise None.
+    """
+    model_dir = os.getenv("ONNX_MODEL_DIR")
+    if model_dir and os.path.isdir(model_dir):
+        return model_dir
+    return None
+
+def embedding_model_id() -> str:
+    """Identifies the embedder in use, so that an index built with another one can be detected."""
+    return _onnx_model_dir() or EMBEDDING_MODEL
+
+def create_document_embedder(progress_bar: bool = True, device: Optional[str] = None):
+    """
+    Returns the ONNX Runtime document embedder if an exported model is available,
+    falling back to the Sentence Transformers embedder otherwise. `device` (e.g.
+    "cpu") pins the Sentence Transformers model to a device instead of the GPU
+    Haystack picks when one is available; the ONNX Runtime embedder runs on the CPU.
+    """
+    model_dir = _onnx_model_dir()
+    if model_dir:
+        return ORTDocumentEmbedder(model_path=model_dir, batch_size=64)
+    # Sentence Transformers already sorts its inputs by length before batching.
+    return SentenceTransformersDocumentEmbedder(
+        model=EMBEDDING_MODEL, batch_size=64, progress_bar=progress_bar,
+        device=ComponentDevice.from_str(device) if device else None,
+    )
@@ -0,0 +1,25 @@
+import sys
+from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
+from transformers import AutoTokenizer
+
+def export_onnx_model(output_dir: str = "onnx", model_id: str = "sentence-transformers/all-MiniLM-L6-v2"):
+    """
+    Exports the embedding model to ONNX and applies dynamic INT8 quantization.
+    The result can be used by the ONNX Runtime embedders by pointing the
+    `ONNX_MODEL_DIR` environment variable at `output_dir`.
+    """
+    model = ORTModelForFeatureExtraction.from_pretrained(model_id, export=True)
+    model.save_pretrained(output_dir)
+    AutoTokenizer.from_pretrained(model_id).save_pretrained(output_dir)
+
+    # Dynamic quantization needs no calibration data; the AVX-512 VNNI config
+    # targets the INT8 dot-product instructions of recent x86 CPUs.
+    quantizer = ORTQuantizer.from_pretrained(model)
+    quantization_config = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    quantizer.quantize(save_dir=output_dir, quantization_config=quantization_config)
+
+    print(f"Quantized ONNX model written to '{output_dir}'.")
+
+if __name__ == "__main__":
+    export_onnx_model(*sys.argv[1:2])
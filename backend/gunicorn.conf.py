@@ -0,0 +1,22 @@
+import os
+
+# Gunicorn configuration for serving the FastAPI app with several worker processes.
+
+bind = "0.0.0.0:8000"
+# Every worker loads its own copy of the LLM (a full llama.cpp context, in VRAM
+# when its layers are offloaded to the GPU), so a single worker is the default
+# when one is configured.
+workers = int(os.getenv("WEB_CONCURRENCY") or (1 if os.getenv("LLM_MODEL_PATH") else 2))
+# Exported so that the app can split the CPU cores between the workers.
+os.environ["WEB_CONCURRENCY"] = str(workers)
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Import the app (and load the Sentence Transformers weights, on the CPU) once in
+# the master process before forking, so all workers share one copy of the weights
+# through copy-on-write instead of each loading its own. Nothing in the master
+# touches CUDA, and everything that is not fork-safe (the Chroma client, the LLM,
+# ONNX Runtime sessions) is created per worker.
+preload_app = True
+
+# Workers load the LLM and warm up the pipeline on startup, which can take a while.
+timeout = 300
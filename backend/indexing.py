@@ -1,32 +1,132 @@
+import json
 import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from haystack import Pipeline
+from typing import Dict, List
+import blake3
+import chromadb
+from haystack import Document, Pipeline
 from haystack.components.converters import TextFileToDocument
-from haystack.components.preprocessors import DocumentSplitter
-from haystack.components.embedders import SentenceTransformersDocumentEmbedder
-from haystack.components.writers import DocumentWriter
 from chroma_haystack import ChromaDocumentStore
 
-def run_indexing_pipeline():
+from components import BulkChromaWriter, Int8EmbeddingStore, TokenSplitter, create_document_embedder, embedding_model_id, set_embedding_threads
+
+# HNSW index parameters of the Chroma collection. The collection is built once
+# and queried many times, so a larger graph (M) and build budget
+# (construction_ef) are used than Chroma's defaults (16 and 100), which only
+# cost indexing time; search_ef (Chroma's default is 10) is the query-time
+# recall/latency knob. Chroma copies all of them into the collection's HNSW
+# index when the collection is created, and later changes to the collection's
+# metadata don't reach the index, so changing any of them rebuilds the
+# collection (see INDEX_SETTINGS).
+HNSW_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:M": int(os.getenv("HNSW_M", "32")),
+    "hnsw:construction_ef": int(os.getenv("HNSW_CONSTRUCTION_EF", "256")),
+    "hnsw:search_ef": int(os.getenv("HNSW_SEARCH_EF", "64")),
+}
+
+def create_document_store(persist_path: str = "chroma_db", collection_name: str = "documents", recreate: bool = False) -> ChromaDocumentStore:
     """
-    Creates and runs a Haystack pipeline to index text files from the 'data' directory
-    into a ChromaDB vector store.
+    Returns a ChromaDocumentStore for the collection. With `recreate`, an existing
+    collection is dropped and the collection is created anew with HNSW_METADATA.
+    ChromaDocumentStore does not accept collection metadata, so the collection is
+    created through the Chroma client first and then picked up by the store's own
+    get_or_create call.
     """
-    # Initialize the document store. It will be created in a 'chroma_db' directory.
-    document_store = ChromaDocumentStore(persist_path="chroma_db")
+    if recreate:
+        client = chromadb.PersistentClient(path=persist_path)
+        # Older Chroma versions list Collection objects, newer ones their names.
+        if collection_name in [getattr(collection, "name", collection) for collection in client.list_collections()]:
+            client.delete_collection(collection_name)
+        client.create_collection(name=collection_name, metadata=HNSW_METADATA)
+    return ChromaDocumentStore(collection_name=collection_name, persist_path=persist_path)
+
+# Documents are split into windows of SPLIT_LENGTH tokens, overlapping by
+# SPLIT_OVERLAP tokens.
+SPLIT_LENGTH = 200
+SPLIT_OVERLAP = 40
+
+# Manifest of the indexed source files and their content hashes, stored next to
+# the database so that unchanged files are not re-embedded on every run. The
+# settings the index was built with are recorded as well: if they change, every
+# file has to be re-indexed.
+MANIFEST_PATH = Path("chroma_db") / ".indexed.json"
+# INT8 copy of the embeddings, searched by the backend when VECTOR_INDEX=int8.
+# Exporting it reads every embedding in the collection, so it is only written
+# when the indexer runs with the same setting.
+INT8_INDEX_PATH = Path("chroma_db") / "int8_index"
+EXPORT_INT8_INDEX = os.getenv("VECTOR_INDEX", "hnsw") == "int8"
+
+INDEX_SETTINGS = {
+    "embedder": embedding_model_id(),
+    "split_length": SPLIT_LENGTH,
+    "split_overlap": SPLIT_OVERLAP,
+    # The index parameters only apply when the collection is created.
+    **HNSW_METADATA,
+}
+
+def hash_file(path: Path) -> str:
+    """Returns the BLAKE3 hex digest of a file's contents."""
+    return blake3.blake3(path.read_bytes()).hexdigest()
+
+def load_manifest() -> Dict[str, str]:
+    """
+    Returns the path -> hash mapping of the files in the current index, or an
+    empty mapping if there is no index or it was built with other settings.
+    """
+    if MANIFEST_PATH.exists():
+        manifest = json.loads(MANIFEST_PATH.read_text())
+        if manifest.get("settings") == INDEX_SETTINGS:
+            return manifest["files"]
+    return {}
+
+def count_documents(document_store: ChromaDocumentStore) -> int:
+    """
+    Returns the number of documents in the store without loading them, using the
+    store's count API where available and Chroma's native count otherwise.
+    """
+    if hasattr(document_store, "count_documents"):
+        return document_store.count_documents()
+    return document_store._collection.count()
 
-    # Define the indexing pipeline
-    indexing_pipeline = Pipeline()
-    indexing_pipeline.add_component("converter", TextFileToDocument())
-    indexing_pipeline.add_component("splitter", DocumentSplitter(split_by="sentence", split_length=10, split_overlap=2))
-    indexing_pipeline.add_component("embedder", SentenceTransformersDocumentEmbedder(model="all-MiniLM-L6-v2"))
-    indexing_pipeline.add_component("writer", DocumentWriter(document_store))
+def delete_source_documents(document_store: ChromaDocumentStore, sources: List[str]):
+    """Deletes all documents that were split from the given source files."""
+    # ChromaDocumentStore.delete_documents only accepts IDs, so delete by metadata
+    # through the underlying collection.
+    for source in sources:
+        document_store._collection.delete(where={"source": source})
+
+def embed_source_files(source_file_paths: List[Path]) -> List[Document]:
+    """
+    Converts, splits and embeds the given text files and returns the embedded
+    Documents. Runs in a worker process, so each worker builds its own pipeline.
+    """
+    # Define the embedding pipeline. It ends at the embedder, whose documents are
+    # returned to the parent process to be written to the store in bulk.
+    embedding_pipeline = Pipeline()
+    embedding_pipeline.add_component("converter", TextFileToDocument())
+    embedding_pipeline.add_component("splitter", TokenSplitter(split_length=SPLIT_LENGTH, split_overlap=SPLIT_OVERLAP))
+    # Uses the INT8 ONNX Runtime embedder if ONNX_MODEL_DIR is set, Sentence Transformers otherwise.
+    embedding_pipeline.add_component("embedder", create_document_embedder())
 
     # Connect the components in the correct order
-    indexing_pipeline.connect("converter.documents", "splitter.documents")
-    indexing_pipeline.connect("splitter.documents", "embedder.documents")
-    indexing_pipeline.connect("embedder.documents", "writer.documents")
+    embedding_pipeline.connect("converter.documents", "splitter.documents")
+    embedding_pipeline.connect("splitter.documents", "embedder.documents")
+
+    # Tag each document with its source file, so it can be deleted when the file changes.
+    meta = [{"source": str(path)} for path in source_file_paths]
+    result = embedding_pipeline.run({"converter": {"sources": source_file_paths, "meta": meta}})
+    return result["embedder"]["documents"]
 
+def run_indexing_pipeline():
+    """
+    Indexes text files from the 'data' directory into a ChromaDB vector store.
+    Only files that changed since the last run are re-indexed. They are converted,
+    split and embedded in parallel worker processes, and the resulting documents
+    are written to the store in bulk.
+    """
     # Identify the source files in the 'data' directory
     # Assumes this script is run from the project's root directory
     source_file_paths = list(Path("data").glob("*.txt"))
@@ -35,12 +135,53 @@ def run_indexing_pipeline():
         print("Warning: No .txt files found in the 'data' directory. The knowledge base will be empty.")
         return
 
-    print(f"Starting indexing for the following files: {[str(p) for p in source_file_paths]}")
+    # Compare content hashes against the manifest of the previous run. Without a
+    # (current) manifest, it is unknown which files the existing documents came
+    # from or how they were built, so the collection is rebuilt from scratch.
+    previous_hashes = load_manifest()
+    rebuild = not previous_hashes
+    hashes = {str(path): hash_file(path) for path in source_file_paths}
+    changed_paths = [path for path in source_file_paths if previous_hashes.get(str(path)) != hashes[str(path)]]
+    stale_sources = [str(path) for path in changed_paths if str(path) in previous_hashes]
+    stale_sources += [source for source in previous_hashes if source not in hashes]
+
+    if not changed_paths and not stale_sources:
+        document_store = create_document_store()
+        if EXPORT_INT8_INDEX and not INT8_INDEX_PATH.exists():
+            Int8EmbeddingStore.export(document_store, INT8_INDEX_PATH)
+        print(f"All files are up to date. {count_documents(document_store)} documents are indexed.")
+        return
+
+    print(f"Starting indexing for the following files: {[str(p) for p in changed_paths]}")
+
+    # Tokenization and embedding are CPU-bound and hold the GIL, so the files are
+    # spread over processes rather than threads. Each process loads its own model,
+    # and the CPU cores are split between them so they don't oversubscribe the CPU.
+    documents = []
+    if changed_paths:
+        num_workers = max(1, min(len(changed_paths), (os.cpu_count() or 1) // 2))
+        num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+        chunks = [changed_paths[i::num_workers] for i in range(num_workers)]
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=set_embedding_threads, initargs=(num_threads,)) as executor:
+            documents = [doc for chunk_documents in executor.map(embed_source_files, chunks) for doc in chunk_documents]
+
+    # Initialize the document store. It will be created in a 'chroma_db' directory.
+    # This happens after the worker processes have been forked, so they don't
+    # inherit the Chroma client.
+    document_store = create_document_store(recreate=rebuild)
+    if not rebuild:
+        delete_source_documents(document_store, stale_sources)
+    BulkChromaWriter(document_store).run(documents=documents)
+    if EXPORT_INT8_INDEX:
+        Int8EmbeddingStore.export(document_store, INT8_INDEX_PATH)
+    elif INT8_INDEX_PATH.exists():
+        # An INT8 copy from an earlier run no longer matches the collection.
+        shutil.rmtree(INT8_INDEX_PATH)
 
-    # Run the pipeline
-    indexing_pipeline.run({"converter": {"sources": source_file_paths}})
+    # Only record the new hashes once the documents have been written.
+    MANIFEST_PATH.write_text(json.dumps({"settings": INDEX_SETTINGS, "files": hashes}, indent=2))
 
-    print(f"Indexing complete. {len(document_store.get_all_documents())} documents have been indexed.")
+    print(f"Indexing complete. {count_documents(document_store)} documents have been indexed.")
 
 if __name__ == "__main__":
     run_indexing_pipeline()
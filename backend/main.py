@@ -1,71 +1,369 @@
+import asyncio
+import hashlib
 import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+import orjson
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from typing import List, Dict, Any
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from typing import List, Dict, Any, Optional
 
-from haystack import Pipeline
-from haystack.components.builders import PromptBuilder
-from haystack.components.embedders import SentenceTransformersTextEmbedder
-from haystack.components.generators.llama_cpp import LlamaCppGenerator
+import torch
+from haystack import Document
 from chroma_haystack import ChromaDocumentStore
-from chroma_haystack.retriever import ChromaQueryTextRetriever
+
+from components import Int8EmbeddingStore, MMRReranker, ORTDocumentEmbedder, create_document_embedder
 
 # --- Haystack RAG Pipeline Setup ---
 
-# This global variable will hold the initialized RAG pipeline.
-rag_pipeline = None
+# Number of Gunicorn worker processes sharing the machine (see gunicorn.conf.py).
+# The CPU cores are split between them so they don't oversubscribe the CPU.
+WORKERS = max(1, int(os.getenv("WEB_CONCURRENCY") or "1"))
+
+# Size torch's CPU thread pools before any model is loaded.
+torch.set_num_threads(int(os.getenv("TORCH_NUM_THREADS", max(1, (os.cpu_count() or 1) // WORKERS))))
+torch.set_num_interop_threads(2)
+
+# The embedder must match the one used by the indexer (see
+# components.create_document_embedder). Haystack's text embedders take a single
+# string, so queries are embedded in batches as Documents by the document embedder.
+#
+# The Sentence Transformers weights are loaded once at import. When the app is
+# served by Gunicorn with `preload_app` (see gunicorn.conf.py), this happens in
+# the master process, and the forked workers share a single copy-on-write copy of
+# the weights. The model is pinned to the CPU: CUDA cannot be used in a process
+# forked after it was initialized, and GPU memory is not shared across fork anyway.
+# ONNX Runtime sessions are not fork-safe, so the ONNX embedder is only warmed up
+# in the workers (see lifespan).
+_EMBEDDER = create_document_embedder(progress_bar=False, device="cpu")
+if not isinstance(_EMBEDDER, ORTDocumentEmbedder):
+    _EMBEDDER.warm_up()
+
+# The document store is opened once per worker process, in the lifespan handler,
+# and searched by every request of that process so its Chroma client and HNSW
+# index stay loaded. It is not opened at import, since SQLite connections
+# must not be inherited across fork.
+_STORE = None
+
+# Vector index used for retrieval: Chroma's FP32 HNSW index ("hnsw"), or an
+# exhaustive scan over the INT8 copy of the embeddings written by the indexer ("int8").
+VECTOR_INDEX = os.getenv("VECTOR_INDEX", "hnsw")
+INT8_INDEX_PATH = Path("chroma_db") / "int8_index"
+
+def open_document_store():
+    """Opens the document store, searched through the configured vector index."""
+    document_store = ChromaDocumentStore(persist_path="chroma_db")
+    if VECTOR_INDEX == "int8":
+        if INT8_INDEX_PATH.exists():
+            return Int8EmbeddingStore(document_store, INT8_INDEX_PATH)
+        print(f"Warning: VECTOR_INDEX is 'int8' but '{INT8_INDEX_PATH}' does not exist. Falling back to the HNSW index.")
+    return document_store
+
+# This global variable will hold the initialized LLM.
+llm = None
+
+# Maximum number of tokens generated per policy.
+LLM_MAX_TOKENS = int(os.getenv("LLM_MAX_TOKENS", "512"))
+
+# Number of documents passed to the LLM, and number of nearest neighbours they
+# are picked from by MMR diversification.
+TOP_K = 5
+FETCH_K = int(os.getenv("RETRIEVAL_FETCH_K", "25"))
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", "0.5"))
+
+# Message returned in place of a generated policy when no LLM is configured.
+NO_LLM_MESSAGE = "LLM generator is not configured. The following documents were retrieved from the knowledge base based on your query."
 
-def build_rag_pipeline():
+# Picks a relevant but diverse subset of the documents retrieved for a query.
+reranker = MMRReranker(top_k=TOP_K, lambda_mult=MMR_LAMBDA)
+
+def load_llm():
     """
-    Builds and returns a Haystack RAG (Retrieval-Augmented Generation) pipeline.
-    The pipeline retrieves relevant documents from ChromaDB and uses them to
-    generate a response with a Large Language Model.
+    Loads and returns the Large Language Model used to generate policies, or None.
+
+    IMPORTANT: This requires llama-cpp-python and a Llama 3 GGUF model file.
+    The path to the model should be set in an environment variable `LLM_MODEL_PATH`.
+    If the variable is not set, no model is loaded and the API will return
+    retrieved documents instead of a generated policy.
+
+    The model is driven through llama-cpp-python directly rather than via a
+    Haystack generator component, so that tokens can be streamed to the client.
     """
-    document_store = ChromaDocumentStore(persist_path="chroma_db")
+    model_path = os.getenv("LLM_MODEL_PATH")
+    if model_path and os.path.exists(model_path):
+        from llama_cpp import Llama
+        # A Q4_K_M quantized GGUF is recommended (see README). All layers are
+        # offloaded to the GPU when llama-cpp-python is built with GPU support;
+        # n_batch sizes the prompt prefill and flash attention reduces KV-cache traffic.
+        # llama.cpp runs best with about one thread per physical core (half the
+        # logical ones); they are split between the workers.
+        n_threads = int(os.getenv("LLM_N_THREADS", max(1, (os.cpu_count() or 2) // 2 // WORKERS)))
+        return Llama(
+            model_path=model_path,
+            n_ctx=2048,
+            n_gpu_layers=int(os.getenv("LLM_N_GPU_LAYERS", "-1")),
+            n_batch=512,
+            n_threads=n_threads,
+            flash_attn=True,
+            verbose=False,
+        )
+
+    print("Warning: LLM_MODEL_PATH is not set or the file does not exist.")
+    print("The RAG pipeline will run without the generator.")
+    return None
+
+# --- Query Cache ---
+
+@dataclass
+class QueryCache:
+    """
+    A thread-safe LRU cache with a per-entry time-to-live, used to skip the
+    embedding and vector search steps for repeated queries. Entries are keyed
+    by a BLAKE2b digest of the query text and hold the retrieved documents.
+    """
+    max_size: int = 2000
+    ttl_seconds: float = 600
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    _entries: "OrderedDict[bytes, tuple]" = field(default_factory=OrderedDict, repr=False)
+    _lock: threading.RLock = field(default_factory=threading.RLock, repr=False)
+
+    @staticmethod
+    def key(query: str) -> bytes:
+        return hashlib.blake2b(query.encode()).digest()
+
+    def get(self, key: bytes) -> Optional[List[Document]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: bytes, value: List[Document]):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Drops all entries and resets the counters, e.g. after the warm-up query."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+query_cache = QueryCache(
+    max_size=int(os.getenv("QUERY_CACHE_SIZE", "2000")),
+    ttl_seconds=float(os.getenv("QUERY_CACHE_TTL_SECONDS", "600")),
+)
+
+def search_documents(queries: List[str]):
+    """
+    Embeds the queries and searches the vector store for them in one batched
+    call each, and returns the reranked documents for each query. The results
+    are added to the query cache.
+
+    The embedder, store and reranker are called directly rather than through a
+    Haystack Pipeline, which would run one query at a time.
+    """
+    embedded = _EMBEDDER.run(documents=[Document(content=query) for query in queries])["documents"]
+    embeddings = [doc.embedding for doc in embedded]
+    # Queries are embedded with the same model as the documents.
+    results = _STORE.search_embeddings(embeddings, top_k=FETCH_K)
+    documents_per_query = []
+    for query, embedding, candidates in zip(queries, embeddings, results):
+        documents = reranker.run(query_embedding=embedding, documents=candidates)["documents"]
+        query_cache.put(QueryCache.key(query), documents)
+        documents_per_query.append(documents)
+    return documents_per_query
+
+def retrieve_documents(queries: List[str]):
+    """
+    Returns the retrieved documents for each query, serving repeated queries
+    from the query cache and searching the rest with search_documents.
+    """
+    documents_per_query = [None] * len(queries)
+    missing = []
+    for i, query in enumerate(queries):
+        cached = query_cache.get(QueryCache.key(query))
+        if cached is None:
+            missing.append(i)
+        else:
+            documents_per_query[i] = cached
+
+    if missing:
+        for i, documents in zip(missing, search_documents([queries[i] for i in missing])):
+            documents_per_query[i] = documents
+
+    return documents_per_query
+
+# --- Request Micro-Batching ---
+
+# Concurrent requests that miss the query cache are put on a queue and coalesced
+# by a background worker, so that N in-flight queries cost a single embedding +
+# vector search call instead of N. A batch is flushed as soon as it holds MAX_BATCH_SIZE queries
+# or MAX_LATENCY_MS has passed since its first query.
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "16"))
+MAX_LATENCY_MS = float(os.getenv("MAX_LATENCY_MS", "50"))
+
+# This global variable will hold the queue feeding the batch worker.
+request_queue = None
+
+# The pipeline components are synchronous, so they run in thread pools to keep
+# the event loop free to accept and coalesce requests. Retrieval for several
+# batches may run at once, while the LLM gets a dedicated single thread so that
+# generations are serialised.
+RETRIEVAL_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv("RETRIEVAL_WORKERS", "4")), thread_name_prefix="retrieval")
+LLM_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llm")
 
-    # 1. Retriever: Fetches relevant documents from the vector store.
-    retriever = ChromaQueryTextRetriever(document_store=document_store, top_k=5)
+async def process_batch(batch):
+    """
+    Searches the documents for a batch of queued queries and resolves the
+    future of each request with its slice of the batched result.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        documents_per_query = await loop.run_in_executor(
+            RETRIEVAL_EXECUTOR, search_documents, [query for query, _ in batch]
+        )
+    except Exception as e:
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(e)
+        return
+
+    for (_, future), documents in zip(batch, documents_per_query):
+        # The future is already done if the client went away in the meantime.
+        if not future.done():
+            future.set_result(documents)
+
+async def batch_worker(queue: asyncio.Queue):
+    """
+    Drains the request queue in micro-batches and hands each batch to its own
+    task, so that the next batch can be collected while the previous one runs.
+    """
+    loop = asyncio.get_running_loop()
+    # Keep references to the running batch tasks so they aren't garbage collected.
+    running = set()
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + MAX_LATENCY_MS / 1000
+        while len(batch) < MAX_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        task = asyncio.create_task(process_batch(batch))
+        running.add(task)
+        task.add_done_callback(running.discard)
+
+async def retrieve(query: str):
+    """
+    Returns the retrieved documents for a query. Repeated queries are answered
+    from the query cache right away; the others are queued for batched retrieval.
+    """
+    cached = query_cache.get(QueryCache.key(query))
+    if cached is not None:
+        return cached
+    future = asyncio.get_running_loop().create_future()
+    await request_queue.put((query, future))
+    return await future
+
+# --- Generation ---
 
-    # 2. Prompt Builder: Creates a prompt for the LLM using the retrieved documents.
-    template = """
+# The prompt is filled with plain string formatting: it only needs the query and
+# a bullet list of the retrieved documents, so a Jinja template rendered by a
+# PromptBuilder component on every request is unnecessary overhead.
+PROMPT_TEMPLATE = """
     Using only the context provided, please generate a concise insurance policy document
     that addresses the user's query. Do not use any external knowledge.
 
     Context:
-    {% for doc in documents %}
-        - {{ doc.content }}
-    {% endfor %}
+{context}
 
-    Query: {{ query }}
+    Query: {query}
 
     Generated Policy:
     """
-    prompt_builder = PromptBuilder(template=template)
 
-    # 3. LLM Generator: Generates text based on the prompt.
-    # IMPORTANT: This component requires a Llama 3 GGUF model file.
-    # The path to the model should be set in an environment variable `LLM_MODEL_PATH`.
-    # If the variable is not set, the generator will not be added to the pipeline,
-    # and the API will return retrieved documents instead of a generated policy.
-    llm = None
-    model_path = os.getenv("LLM_MODEL_PATH")
-    if model_path and os.path.exists(model_path):
-        llm = LlamaCppGenerator(model_path=model_path, n_ctx=2048)
-    else:
-        print("Warning: LLM_MODEL_PATH is not set or the file does not exist.")
-        print("The RAG pipeline will run without the generator.")
+def build_prompt(query: str, documents) -> str:
+    """Builds the LLM prompt for a query from its retrieved documents."""
+    context = "\n".join(f"        - {doc.content}" for doc in documents)
+    return PROMPT_TEMPLATE.format(context=context, query=query)
 
-    # 4. Build the Pipeline
-    pipeline = Pipeline()
-    pipeline.add_component("retriever", retriever)
-    pipeline.add_component("prompt_builder", prompt_builder)
-    pipeline.connect("retriever.documents", "prompt_builder.documents")
+def generate_reply(prompt: str) -> str:
+    """Generates the full policy for a prompt with the LLM."""
+    return llm.create_completion(prompt, max_tokens=LLM_MAX_TOKENS)["choices"][0]["text"]
+
+def stream_reply_into(prompt: str, loop, tokens: asyncio.Queue, cancelled: threading.Event):
+    """
+    Generates the policy for a prompt with the LLM and pushes its tokens onto
+    an asyncio queue owned by `loop`, followed by None once generation ends.
+    Runs on the LLM thread.
+    """
+    try:
+        for chunk in llm.create_completion(prompt, max_tokens=LLM_MAX_TOKENS, stream=True):
+            if cancelled.is_set():
+                break
+            loop.call_soon_threadsafe(tokens.put_nowait, chunk["choices"][0]["text"])
+    finally:
+        loop.call_soon_threadsafe(tokens.put_nowait, None)
 
-    if llm:
-        pipeline.add_component("llm", llm)
-        pipeline.connect("prompt_builder.prompt", "llm.prompt")
+async def stream_reply(prompt: str):
+    """
+    Yields the tokens of the policy generated for a prompt as they are decoded.
+    The whole generation holds the LLM thread, so concurrent streams don't
+    interleave on the same model context.
+    """
+    loop = asyncio.get_running_loop()
+    tokens = asyncio.Queue()
+    cancelled = threading.Event()
+    generation = loop.run_in_executor(LLM_EXECUTOR, stream_reply_into, prompt, loop, tokens, cancelled)
+    try:
+        while (token := await tokens.get()) is not None:
+            yield token
+        # Surfaces any exception raised during generation.
+        await generation
+    finally:
+        # Stops generating if the client disconnected mid-stream.
+        cancelled.set()
 
-    return pipeline
+def serialize_document(doc: Document) -> Dict[str, Any]:
+    """
+    Converts a retrieved Document to the dictionary sent to the client. Unlike
+    `Document.to_dict()`, this leaves out the embedding, which the client doesn't use.
+    """
+    return {"content": doc.content, "score": doc.score, "meta": doc.meta}
 
 # --- FastAPI Application ---
 
@@ -74,18 +372,41 @@ import contextlib
 @contextlib.asynccontextmanager
 async def lifespan(app):
     """
-    Initializes the RAG pipeline when the FastAPI application starts.
+    Opens the document store, loads the LLM and starts the batch worker when
+    the FastAPI application starts.
     """
-    global rag_pipeline
-    rag_pipeline = build_rag_pipeline()
-    print("RAG pipeline built successfully.")
+    global _STORE, llm, request_queue
+    # Loads the ONNX Runtime session of this worker (a no-op for the preloaded
+    # Sentence Transformers model).
+    _EMBEDDER.warm_up()
+    _STORE = open_document_store()
+    llm = load_llm()
+    print("Document store opened successfully.")
+
+    # Run a throwaway query through the same path as user requests, so the first
+    # of them doesn't pay for the first forward pass (kernel selection, thread
+    # pool start-up) or for loading the vector index. It is dropped from the
+    # query cache and its statistics again. The LLM is primed with a short completion so its
+    # weights are paged into memory.
+    retrieve_documents(["warm-up"])
+    query_cache.clear()
+    if llm is not None:
+        llm.create_completion("warm-up", max_tokens=4)
+    print("Retrieval and LLM warmed up.")
+
+    request_queue = asyncio.Queue()
+    worker = asyncio.create_task(batch_worker(request_queue))
     yield
+    worker.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await worker
 
 app = FastAPI(
     title="Insurance Policy Generation Chatbot API",
     description="An API for generating insurance policies using a RAG pipeline.",
     version="1.0.0",
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 class PolicyRequest(BaseModel):
     query: str
@@ -94,37 +415,93 @@ class PolicyResponse(BaseModel):
     policy: str
     retrieved_documents: List[Dict[str, Any]]
 
+class BatchPolicyRequest(BaseModel):
+    # Capped at one micro-batch, so that a single request can't monopolise the
+    # retrieval and LLM threads that interactive requests share.
+    queries: List[str] = Field(min_length=1, max_length=MAX_BATCH_SIZE)
+
 @app.get("/")
 def read_root():
     """A simple endpoint to confirm the API is running."""
     return {"message": "Welcome to the Insurance Policy Generation Chatbot API"}
 
+@app.get("/cache_stats")
+def cache_stats():
+    """Returns hit, miss and eviction counters of the query cache."""
+    return query_cache.stats()
+
 @app.post("/generate_policy", response_model=PolicyResponse)
 async def generate_policy(request: PolicyRequest):
     """
     Generates an insurance policy based on a user's query by running the RAG pipeline.
     If an LLM is configured, it returns a generated policy. Otherwise, it returns
     the documents retrieved from the knowledge base.
+
+    Retrieval for concurrent requests is micro-batched by the background batch worker.
     """
-    if rag_pipeline is None:
+    if _STORE is None or request_queue is None:
         raise HTTPException(status_code=500, detail="RAG pipeline is not initialized.")
 
-    # The components to run depend on whether the LLM is available
-    if "llm" in rag_pipeline.components:
-        # Run the full pipeline
-        result = rag_pipeline.run({
-            "retriever": {"query": request.query},
-            "prompt_builder": {"query": request.query}
-        })
-        policy = result["llm"]["replies"][0]
-        retrieved_docs = result["retriever"]["documents"]
+    retrieved_docs = await retrieve(request.query)
+    if llm is None:
+        policy = NO_LLM_MESSAGE
     else:
-        # Run only the retrieval part
-        result = rag_pipeline.run({"retriever": {"query": request.query}})
-        policy = "LLM generator is not configured. The following documents were retrieved from the knowledge base based on your query."
-        retrieved_docs = result["retriever"]["documents"]
+        prompt = build_prompt(request.query, retrieved_docs)
+        policy = await asyncio.get_running_loop().run_in_executor(LLM_EXECUTOR, generate_reply, prompt)
 
     # Convert Haystack Document objects to dictionaries for the response
-    retrieved_docs_dict = [doc.to_dict() for doc in retrieved_docs]
+    retrieved_docs_dict = [serialize_document(doc) for doc in retrieved_docs]
 
     return {"policy": policy, "retrieved_documents": retrieved_docs_dict}
+
+@app.post("/generate_policy_batch", response_model=List[PolicyResponse])
+async def generate_policy_batch(request: BatchPolicyRequest):
+    """
+    Generates one insurance policy per query, for clients that already hold a
+    list of queries (e.g. bulk generation or evaluation runs). The queries are
+    embedded and searched as a single batch; the responses are returned in the
+    same order as the queries. At most MAX_BATCH_SIZE queries are accepted per
+    request.
+    """
+    if _STORE is None:
+        raise HTTPException(status_code=500, detail="RAG pipeline is not initialized.")
+
+    loop = asyncio.get_running_loop()
+    documents_per_query = await loop.run_in_executor(RETRIEVAL_EXECUTOR, retrieve_documents, request.queries)
+
+    if llm is None:
+        policies = [NO_LLM_MESSAGE] * len(request.queries)
+    else:
+        # llama.cpp generates one sequence at a time, so each prompt is queued on
+        # the LLM thread separately, letting other requests' generations interleave.
+        prompts = [build_prompt(query, documents) for query, documents in zip(request.queries, documents_per_query)]
+        policies = await asyncio.gather(*[loop.run_in_executor(LLM_EXECUTOR, generate_reply, prompt) for prompt in prompts])
+
+    return [
+        {"policy": policy, "retrieved_documents": [serialize_document(doc) for doc in documents]}
+        for policy, documents in zip(policies, documents_per_query)
+    ]
+
+@app.post("/generate_policy_stream")
+async def generate_policy_stream(request: PolicyRequest):
+    """
+    Same as /generate_policy, but streams the generated policy token by token.
+
+    The response is newline-delimited JSON: the first line holds the
+    `retrieved_documents`, and each following line holds one generated `token`.
+    """
+    if _STORE is None or request_queue is None:
+        raise HTTPException(status_code=500, detail="RAG pipeline is not initialized.")
+
+    retrieved_docs = await retrieve(request.query)
+
+    async def generate():
+        retrieved_docs_dict = [serialize_document(doc) for doc in retrieved_docs]
+        yield orjson.dumps({"retrieved_documents": retrieved_docs_dict}) + b"\n"
+        if llm is None:
+            yield orjson.dumps({"token": NO_LLM_MESSAGE}) + b"\n"
+            return
+        async for token in stream_reply(build_prompt(request.query, retrieved_docs)):
+            yield orjson.dumps({"token": token}) + b"\n"
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
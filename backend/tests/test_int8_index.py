@@ -0,0 +1,87 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from haystack import Document
+
+from components import Int8EmbeddingStore
+
+class FakeCollection:
+    """The part of the Chroma collection API that Int8EmbeddingStore uses."""
+
+    def __init__(self, embeddings: np.ndarray):
+        self.embeddings = embeddings
+
+    def count(self):
+        return len(self.embeddings)
+
+    def get(self, ids=None, include=(), limit=None, offset=0):
+        if ids is None:
+            rows = range(offset, min(offset + limit, len(self.embeddings)))
+        else:
+            rows = [int(doc_id.split("-")[1]) for doc_id in ids]
+        return {
+            "ids": [f"doc-{i}" for i in rows],
+            "embeddings": [self.embeddings[i].tolist() for i in rows],
+            "documents": [f"content {i}" for i in rows],
+            "metadatas": [{"row": i} for i in rows],
+        }
+
+def unit_vectors(rng, n, dim=384):
+    vectors = rng.standard_normal((n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+@pytest.fixture
+def embeddings():
+    # Clusters of vectors with a cosine similarity of about 0.5 to each other, so
+    # that the nearest neighbours of a query stand out from the rest like those
+    # of related sentences.
+    rng = np.random.default_rng(0)
+    centers = unit_vectors(rng, 50)
+    vectors = centers[rng.integers(0, len(centers), 3000)] + unit_vectors(rng, 3000)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+@pytest.fixture
+def store(embeddings, tmp_path):
+    document_store = SimpleNamespace(_collection=FakeCollection(embeddings))
+    # Small pages and blocks, so that paging and blocking are exercised.
+    Int8EmbeddingStore.export(document_store, tmp_path, page_size=700)
+    return Int8EmbeddingStore(document_store, tmp_path, block_size=512)
+
+def test_recall_against_exact_search(store, embeddings):
+    rng = np.random.default_rng(1)
+    queries = embeddings[rng.integers(0, len(embeddings), 20)] + 0.05 * unit_vectors(rng, 20)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    top_k = 10
+
+    exact = np.argsort(-(queries @ embeddings.T), axis=1)[:, :top_k]
+    results = store.search_embeddings(queries.tolist(), top_k=top_k)
+
+    hits = sum(
+        len({f"doc-{i}" for i in expected} & {doc.id for doc in documents})
+        for expected, documents in zip(exact, results)
+    )
+    assert hits / exact.size >= 0.95
+
+def test_results_are_ordered_by_distance(store, embeddings):
+    results = store.search_embeddings(embeddings[[5, 17]].tolist(), top_k=8)
+
+    for row, documents in zip([5, 17], results):
+        assert len(documents) == 8
+        # A stored vector is its own nearest neighbour, at a cosine distance of ~0.
+        assert documents[0].id == f"doc-{row}"
+        assert documents[0].score == pytest.approx(0, abs=1e-2)
+        scores = [doc.score for doc in documents]
+        assert scores == sorted(scores)
+        for doc in documents:
+            assert doc.content == f"content {doc.meta['row']}"
+            assert doc.id == f"doc-{doc.meta['row']}"
+
+def test_filters_restrict_the_scan(store, embeddings):
+    even_rows = [Document(id=f"doc-{i}") for i in range(0, len(embeddings), 2)]
+    store.document_store.filter_documents = lambda filters: even_rows
+
+    results = store.search_embeddings(embeddings[[5]].tolist(), top_k=8, filters={"row": "even"})
+
+    assert len(results[0]) == 8
+    assert all(doc.meta["row"] % 2 == 0 for doc in results[0])
@@ -1,5 +1,6 @@
+import json
+import httpx
 import streamlit as st
-import requests
 
 # --- Page Configuration ---
 st.set_page_config(
@@ -8,6 +9,20 @@ st.set_page_config(
     layout="wide",
 )
 
+# --- Backend Client ---
+@st.cache_resource
+def get_backend_client():
+    """
+    Returns an HTTP client for the backend API. It is cached across reruns and
+    sessions, so connections to the backend are kept alive and reused.
+    """
+    # The FastAPI backend service is named 'backend' in docker-compose.
+    return httpx.Client(
+        base_url="http://backend:8000",
+        timeout=60,
+        limits=httpx.Limits(max_keepalive_connections=8),
+    )
+
 # --- Application Title and Description ---
 st.title("Insurance Policy Generation Chatbot")
 st.markdown(
@@ -38,17 +53,17 @@ with st.form("policy_form"):
 if submit_button and query:
     with st.spinner("Generating your policy... This may take a moment."):
         try:
-            # The FastAPI backend service is named 'backend' in docker-compose
-            api_url = "http://backend:8000/generate_policy"
-
-            response = requests.post(api_url, json={"query": query}, timeout=60)
-            response.raise_for_status()  # Raise an exception for HTTP errors
+            # The streaming endpoint sends newline-delimited JSON: the retrieved
+            # documents first, then the policy one token at a time.
+            with get_backend_client().stream("POST", "/generate_policy_stream", json={"query": query}) as response:
+                response.raise_for_status()  # Raise an exception for HTTP errors
 
-            result = response.json()
+                lines = (json.loads(line) for line in response.iter_lines() if line)
+                retrieved_documents = next(lines, {}).get("retrieved_documents", [])
 
-            st.divider()
-            st.subheader("📜 Generated Policy")
-            st.markdown(result.get("policy", "No policy was generated."))
+                st.divider()
+                st.subheader("📜 Generated Policy")
+                st.write_stream(message["token"] for message in lines)
 
             st.divider()
             st.subheader("🧠 Retrieved Documents")
@@ -56,7 +71,6 @@ if submit_button and query:
                 "These are the top documents retrieved from the knowledge base that were used as context for the generation."
             )
 
-            retrieved_documents = result.get("retrieved_documents", [])
             if retrieved_documents:
                 for i, doc in enumerate(retrieved_documents):
                     with st.expander(f"**Document {i+1}** (Score: {doc['score']:.2f})"):
@@ -66,7 +80,7 @@ if submit_button and query:
             else:
                 st.warning("No documents were retrieved from the knowledge base.")
 
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             st.error(f"Could not connect to the backend API. Please ensure the backend service is running. Error: {e}")
         except Exception as e:
             st.error(f"An unexpected error occurred: {e}")